@@ -1,34 +1,60 @@
 -- PostgreSQL schema for rate limiter analytics
 
 CREATE TABLE IF NOT EXISTS request_logs (
-    id SERIAL PRIMARY KEY,
+    id SERIAL,
     client_id VARCHAR(255) NOT NULL,
     endpoint VARCHAR(255) NOT NULL,
     allowed BOOLEAN NOT NULL,
     strategy VARCHAR(50),
     limit_value INTEGER,
     remaining INTEGER,
-    timestamp TIMESTAMP NOT NULL DEFAULT NOW()
-);
+    timestamp_epoch BIGINT NOT NULL DEFAULT EXTRACT(EPOCH FROM NOW())::bigint,  -- Unix seconds
+    PRIMARY KEY (id, timestamp_epoch)
+) PARTITION BY RANGE (timestamp_epoch);
 
--- Indexes for performance
+-- Catch-all for rows outside the monthly partitions
+CREATE TABLE IF NOT EXISTS request_logs_default PARTITION OF request_logs DEFAULT;
+
+-- Monthly partitions from the current month up to months_ahead.
+-- Idempotent; log_consumer.py calls it at startup and hourly to stay ahead.
+CREATE OR REPLACE FUNCTION create_request_logs_partitions(months_ahead INTEGER DEFAULT 2)
+RETURNS void AS $$
+DECLARE
+    month_start TIMESTAMPTZ;
+BEGIN
+    FOR i IN 0..months_ahead LOOP
+        month_start := date_trunc('month', NOW()) + make_interval(months => i);
+        EXECUTE format(
+            'CREATE TABLE IF NOT EXISTS %I PARTITION OF request_logs FOR VALUES FROM (%L) TO (%L)',
+            'request_logs_' || to_char(month_start, 'YYYYMM'),
+            EXTRACT(EPOCH FROM month_start)::bigint,
+            EXTRACT(EPOCH FROM month_start + INTERVAL '1 month')::bigint
+        );
+    END LOOP;
+END;
+$$ LANGUAGE plpgsql;
+
+SELECT create_request_logs_partitions();
+
+-- Indexes for performance (created on every partition)
 CREATE INDEX idx_request_logs_client ON request_logs(client_id);
-CREATE INDEX idx_request_logs_timestamp ON request_logs(timestamp DESC);
+CREATE INDEX idx_request_logs_timestamp_allowed ON request_logs(timestamp_epoch, allowed);
+CREATE INDEX idx_request_logs_timestamp_brin ON request_logs USING BRIN (timestamp_epoch) WITH (pages_per_range = 32);
 CREATE INDEX idx_request_logs_endpoint ON request_logs(endpoint);
 CREATE INDEX idx_request_logs_allowed ON request_logs(allowed);
 
 -- View for hourly statistics
 CREATE OR REPLACE VIEW hourly_stats AS
 SELECT 
-    date_trunc('hour', timestamp) as hour,
+    to_timestamp(timestamp_epoch - timestamp_epoch % 3600) as hour,
     endpoint,
     COUNT(*) as total_requests,
     SUM(CASE WHEN allowed THEN 1 ELSE 0 END) as allowed_requests,
     SUM(CASE WHEN NOT allowed THEN 1 ELSE 0 END) as blocked_requests,
     ROUND(100.0 * SUM(CASE WHEN NOT allowed THEN 1 ELSE 0 END) / COUNT(*), 2) as block_percentage
 FROM request_logs
-WHERE timestamp > NOW() - INTERVAL '24 hours'
-GROUP BY date_trunc('hour', timestamp), endpoint
+WHERE timestamp_epoch > EXTRACT(EPOCH FROM NOW())::bigint - 86400
+GROUP BY timestamp_epoch - timestamp_epoch % 3600, endpoint
 ORDER BY hour DESC;
 
 -- View for top abusers
@@ -36,11 +62,11 @@ CREATE OR REPLACE VIEW top_blocked_clients AS
 SELECT 
     client_id,
     COUNT(*) as blocked_count,
-    MAX(timestamp) as last_blocked,
+    to_timestamp(MAX(timestamp_epoch)) as last_blocked,
     ARRAY_AGG(DISTINCT endpoint) as endpoints
 FROM request_logs
 WHERE NOT allowed 
-AND timestamp > NOW() - INTERVAL '24 hours'
+AND timestamp_epoch > EXTRACT(EPOCH FROM NOW())::bigint - 86400
 GROUP BY client_id
 HAVING COUNT(*) > 10
 ORDER BY blocked_count DESC
@@ -57,6 +83,22 @@ SELECT
     ROUND(AVG(limit_value), 2) as avg_limit,
     ROUND(AVG(remaining), 2) as avg_remaining
 FROM request_logs
-WHERE timestamp > NOW() - INTERVAL '1 hour'
+WHERE timestamp_epoch > EXTRACT(EPOCH FROM NOW())::bigint - 3600
 GROUP BY endpoint, strategy
 ORDER BY total_requests DESC;
+
+-- Per-minute rollup for the dashboard time series.
+-- Refreshed with REFRESH MATERIALIZED VIEW CONCURRENTLY by the dashboard.
+CREATE MATERIALIZED VIEW IF NOT EXISTS request_logs_1m AS
+SELECT 
+    to_timestamp(timestamp_epoch - timestamp_epoch % 60) as minute,
+    endpoint,
+    COUNT(*) as total,
+    SUM(CASE WHEN allowed THEN 1 ELSE 0 END) as allowed,
+    SUM(CASE WHEN NOT allowed THEN 1 ELSE 0 END) as blocked
+FROM request_logs
+WHERE timestamp_epoch > EXTRACT(EPOCH FROM NOW())::bigint - 3600
+GROUP BY timestamp_epoch - timestamp_epoch % 60, endpoint;
+
+-- Unique index required for concurrent refresh
+CREATE UNIQUE INDEX IF NOT EXISTS idx_request_logs_1m_minute_endpoint ON request_logs_1m(minute, endpoint);
@@ -3,56 +3,87 @@
 Load testing script for rate limiter.
 Simulates multiple clients making concurrent requests.
 """
-import requests
+import aiohttp
+import asyncio
+import numpy as np
 import time
-import threading
-import statistics
-from collections import defaultdict
+from collections import Counter
 from datetime import datetime
 
 
 class LoadTester:
-    def __init__(self, base_url, num_clients=10, requests_per_client=20):
+    def __init__(self, base_url, num_clients=10, requests_per_client=20, rps=10.0):
         self.base_url = base_url
         self.num_clients = num_clients
         self.requests_per_client = requests_per_client
-        self.results = defaultdict(list)
-        self.lock = threading.Lock()
+        self.interval = 1.0 / rps
+        self.completed = 0
+        self.last_error = None
     
-    def make_requests(self, client_id):
-        """Make requests from a single client."""
-        session = requests.Session()
-        session.headers.update({'X-API-Key': f'client_{client_id}'})
+    async def make_requests(self, session, client_id, latencies):
+        """
+        Make requests from a single client at a fixed rate.
         
-        latencies = []
-        status_codes = []
+        Args:
+            latencies: This client's slice of the shared latency buffer (ms);
+                entries for failed requests are left as NaN
         
+        Returns:
+            Counter of status codes
+        """
+        loop = asyncio.get_running_loop()
+        headers = {'X-API-Key': f'client_{client_id}'}
+        
+        status_counts = Counter()
+        
+        next_send = loop.time()
         for i in range(self.requests_per_client):
-            start = time.time()
+            await asyncio.sleep(max(0, next_send - loop.time()))
+            # Measure from the scheduled send time so a slow server can't hide
+            # its delay by pushing later requests back (coordinated omission)
+            start = next_send
+            next_send += self.interval
             try:
-                response = session.get(f'{self.base_url}/api/data')
-                latency = (time.time() - start) * 1000  # ms
-                
-                latencies.append(latency)
-                status_codes.append(response.status_code)
-                
-                # Print progress
-                if response.status_code == 200:
-                    print(f"✓ Client {client_id} - Request {i+1}: {latency:.2f}ms")
-                else:
-                    print(f"✗ Client {client_id} - Request {i+1}: {response.status_code}")
+                async with session.get(f'{self.base_url}/api/data', headers=headers) as response:
+                    await response.read()
+                    status = response.status
+                latency = (loop.time() - start) * 1000  # ms
                 
+                latencies[i] = latency
+                status_counts[status] += 1
             except Exception as e:
-                print(f"✗ Client {client_id} - Request {i+1}: ERROR - {e}")
-                status_codes.append(0)
+                self.last_error = e
+                status_counts[0] += 1
             
-            time.sleep(0.1)  # Small delay between requests
+            self.completed += 1
         
-        with self.lock:
-            self.results[client_id] = {
-                'latencies': latencies,
-                'status_codes': status_codes
-            }
+        return status_counts
+    
+    async def report_progress(self, total):
+        """Print a progress line every second, outside the timed request path."""
+        while True:
+            await asyncio.sleep(1)
+            print(f"progress: {self.completed} / {total}")
+    
+    async def _run(self, latencies):
+        """Drive every client from one event loop over a shared connection pool."""
+        # One keep-alive connection per client so no request waits on the pool
+        connector = aiohttp.TCPConnector(
+            limit=self.num_clients,
+            limit_per_host=self.num_clients,
+            keepalive_timeout=60,
+            ttl_dns_cache=300
+        )
+        async with aiohttp.ClientSession(connector=connector) as session:
+            n = self.requests_per_client
+            reporter = asyncio.create_task(self.report_progress(len(latencies)))
+            try:
+                return await asyncio.gather(*(
+                    self.make_requests(session, client_id, latencies[client_id * n:(client_id + 1) * n])
+                    for client_id in range(self.num_clients)
+                ))
+            finally:
+                reporter.cancel()
     
     def run(self):
         """Run the load test."""
@@ -61,41 +92,28 @@ class LoadTester:
         print(f"{'='*60}")
         print(f"Clients: {self.num_clients}")
         print(f"Requests per client: {self.requests_per_client}")
+        print(f"Rate per client: {1 / self.interval:g} req/s")
         print(f"Total requests: {self.num_clients * self.requests_per_client}")
         print(f"Target: {self.base_url}")
         print(f"{'='*60}\n")
         
         start_time = time.time()
         
-        # Create threads for each client
-        threads = []
-        for client_id in range(self.num_clients):
-            thread = threading.Thread(
-                target=self.make_requests,
-                args=(client_id,)
-            )
-            threads.append(thread)
-            thread.start()
-        
-        # Wait for all threads
-        for thread in threads:
-            thread.join()
+        # Each client writes into its own slice of one preallocated buffer
+        latencies = np.full(self.num_clients * self.requests_per_client, np.nan)
+        results = asyncio.run(self._run(latencies))
         
         duration = time.time() - start_time
         
+        # Merge per-client results
+        all_latencies = latencies[~np.isnan(latencies)]
+        status_counts = sum(results, Counter())
+        
         # Analyze results
-        self.print_results(duration)
+        self.print_results(duration, all_latencies, status_counts)
     
-    def print_results(self, duration):
+    def print_results(self, duration, all_latencies, status_counts):
         """Print test results and statistics."""
-        all_latencies = []
-        status_counts = defaultdict(int)
-        
-        for client_data in self.results.values():
-            all_latencies.extend(client_data['latencies'])
-            for status in client_data['status_codes']:
-                status_counts[status] += 1
-        
         print(f"\n{'='*60}")
         print(f"📊 Load Test Results")
         print(f"{'='*60}")
@@ -103,18 +121,16 @@ class LoadTester:
         print(f"  Total Duration: {duration:.2f}s")
         print(f"  Requests/sec: {len(all_latencies) / duration:.2f}")
         
-        if all_latencies:
+        if len(all_latencies):
+            # One partition-based pass for all percentiles, no full sort
+            p50, p95, p99 = np.percentile(all_latencies, [50, 95, 99])
             print(f"\n📈 Latency Statistics:")
-            print(f"  Min: {min(all_latencies):.2f}ms")
-            print(f"  Max: {max(all_latencies):.2f}ms")
-            print(f"  Mean: {statistics.mean(all_latencies):.2f}ms")
-            print(f"  Median: {statistics.median(all_latencies):.2f}ms")
-            
-            sorted_latencies = sorted(all_latencies)
-            p95_idx = int(len(sorted_latencies) * 0.95)
-            p99_idx = int(len(sorted_latencies) * 0.99)
-            print(f"  P95: {sorted_latencies[p95_idx]:.2f}ms")
-            print(f"  P99: {sorted_latencies[p99_idx]:.2f}ms")
+            print(f"  Min: {all_latencies.min():.2f}ms")
+            print(f"  Max: {all_latencies.max():.2f}ms")
+            print(f"  Mean: {all_latencies.mean():.2f}ms")
+            print(f"  Median: {p50:.2f}ms")
+            print(f"  P95: {p95:.2f}ms")
+            print(f"  P99: {p99:.2f}ms")
         
         print(f"\n📋 Status Code Distribution:")
         total_requests = sum(status_counts.values())
@@ -130,6 +146,8 @@ class LoadTester:
         print(f"  Success Rate: {success_rate:.1f}%")
         print(f"  Block Rate: {block_rate:.1f}%")
         print(f"  Error Rate: {100 - success_rate - block_rate:.1f}%")
+        if self.last_error is not None:
+            print(f"  Last Error: {self.last_error}")
         
         print(f"\n{'='*60}\n")
 
@@ -144,13 +162,18 @@ def main():
                        help='Number of concurrent clients')
     parser.add_argument('--requests', type=int, default=20,
                        help='Requests per client')
+    parser.add_argument('--rps', type=float, default=10.0,
+                       help='Requests per second per client')
     
     args = parser.parse_args()
+    if args.rps <= 0:
+        parser.error('--rps must be greater than 0')
     
     tester = LoadTester(
         base_url=args.url,
         num_clients=args.clients,
-        requests_per_client=args.requests
+        requests_per_client=args.requests,
+        rps=args.rps
     )
     
     tester.run()
@@ -1,12 +1,14 @@
 """
 API Gateway with rate limiting middleware.
 """
-from flask import Flask, request, jsonify, g
+from flask import Flask, request, jsonify, make_response, g
 from functools import wraps
 import redis
 import psycopg2
-from psycopg2.extras import execute_values
+from psycopg2.pool import ThreadedConnectionPool
 import logging
+import queue
+import threading
 import time
 import os
 from datetime import datetime
@@ -25,16 +27,38 @@ app = Flask(__name__)
 # Configuration
 REDIS_HOST = os.getenv('REDIS_HOST', 'localhost')
 REDIS_PORT = int(os.getenv('REDIS_PORT', 6379))
+REDIS_MAX_CONNECTIONS = int(os.getenv('REDIS_MAX_CONNECTIONS', 16))
 POSTGRES_HOST = os.getenv('POSTGRES_HOST', 'localhost')
 POSTGRES_DB = os.getenv('POSTGRES_DB', 'ratelimiter')
 POSTGRES_USER = os.getenv('POSTGRES_USER', 'postgres')
 POSTGRES_PASSWORD = os.getenv('POSTGRES_PASSWORD', 'postgres')
+POSTGRES_POOL_MIN = int(os.getenv('POSTGRES_POOL_MIN', 5))
+POSTGRES_POOL_MAX = int(os.getenv('POSTGRES_POOL_MAX', 50))
 
-# Initialize Redis
-redis_client = redis.Redis(
+# Request log batching (rows go to a Redis stream, see log_consumer.py)
+LOG_STREAM = os.getenv('LOG_STREAM', 'request_logs')
+LOG_STREAM_MAXLEN = 1_000_000
+LOG_QUEUE_SIZE = 10000
+LOG_BATCH_SIZE = 500
+LOG_FLUSH_INTERVAL = 0.1  # seconds
+
+# Initialize Redis (one bounded pool per worker, shared by all request threads).
+# Replies are left as bytes: the limiter scripts return integers and nothing
+# on the request path reads a string reply, so decoding would be wasted work.
+redis_pool = redis.BlockingConnectionPool(
+    host=REDIS_HOST,
+    port=REDIS_PORT,
+    socket_connect_timeout=2,
+    socket_timeout=2,
+    max_connections=REDIS_MAX_CONNECTIONS,
+    timeout=2
+)
+redis_client = redis.Redis(connection_pool=redis_pool)
+# The log writer thread gets its own connection, so it never holds one of the
+# request threads' pool slots while a batch is in flight
+log_redis_client = redis.Redis(
     host=REDIS_HOST,
     port=REDIS_PORT,
-    decode_responses=True,
     socket_connect_timeout=2,
     socket_timeout=2
 )
@@ -43,49 +67,105 @@ redis_client = redis.Redis(
 limiter = RateLimiter(redis_client, fallback_mode=True)
 
 
+_db_pool = None
+_db_pool_lock = threading.Lock()
+
+
+def get_db_pool() -> ThreadedConnectionPool:
+    """Create the PostgreSQL connection pool on first use."""
+    global _db_pool
+    if _db_pool is None:
+        with _db_pool_lock:
+            if _db_pool is None:
+                _db_pool = ThreadedConnectionPool(
+                    POSTGRES_POOL_MIN,
+                    POSTGRES_POOL_MAX,
+                    host=POSTGRES_HOST,
+                    database=POSTGRES_DB,
+                    user=POSTGRES_USER,
+                    password=POSTGRES_PASSWORD
+                )
+    return _db_pool
+
+
 def get_db():
-    """Get PostgreSQL connection from g or create new one."""
+    """Borrow a PostgreSQL connection from the pool for this request."""
     if 'db' not in g:
-        g.db = psycopg2.connect(
-            host=POSTGRES_HOST,
-            database=POSTGRES_DB,
-            user=POSTGRES_USER,
-            password=POSTGRES_PASSWORD
-        )
+        g.db = get_db_pool().getconn()
     return g.db
 
 
 @app.teardown_appcontext
 def close_db(error):
-    """Close database connection at end of request."""
+    """Return database connection to the pool at end of request."""
     db = g.pop('db', None)
     if db is not None:
-        db.close()
+        # Reset session state; drop the connection instead if it is broken
+        broken = bool(db.closed)
+        if not broken:
+            try:
+                db.rollback()
+            except psycopg2.Error:
+                broken = True
+        get_db_pool().putconn(db, close=broken)
+
+
+LOG_QUEUE = queue.Queue(maxsize=LOG_QUEUE_SIZE)
 
 
 def log_request(client_id: str, endpoint: str, allowed: bool, metadata: dict):
-    """Log request to PostgreSQL for analytics."""
+    """Queue request for analytics logging (drops the row if the queue is full)."""
     try:
-        db = get_db()
-        cursor = db.cursor()
-        
-        cursor.execute("""
-            INSERT INTO request_logs 
-            (client_id, endpoint, allowed, strategy, limit_value, remaining, timestamp)
-            VALUES (%s, %s, %s, %s, %s, %s, %s)
-        """, (
+        LOG_QUEUE.put_nowait((
             client_id,
             endpoint,
             allowed,
             metadata.get('strategy'),
             metadata.get('limit'),
             metadata.get('remaining'),
-            datetime.now()
+            int(time.time())
         ))
-        
-        db.commit()
-    except Exception as e:
-        logger.error(f"Failed to log request: {e}")
+    except queue.Full:
+        logger.warning("Request log queue full, dropping log entry")
+
+
+def _drain_log_queue() -> list:
+    """Block for the first row, then collect up to a batch within the flush interval."""
+    rows = [LOG_QUEUE.get()]
+    deadline = time.monotonic() + LOG_FLUSH_INTERVAL
+    while len(rows) < LOG_BATCH_SIZE:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        try:
+            rows.append(LOG_QUEUE.get(timeout=remaining))
+        except queue.Empty:
+            break
+    return rows
+
+
+def log_writer():
+    """Background worker that ships queued request logs to the Redis stream in batches."""
+    while True:
+        rows = _drain_log_queue()
+        try:
+            pipe = log_redis_client.pipeline(transaction=False)
+            for client_id, endpoint, allowed, strategy, limit, remaining, ts in rows:
+                pipe.xadd(LOG_STREAM, {
+                    'client_id': client_id,
+                    'endpoint': endpoint,
+                    'allowed': int(allowed),
+                    'strategy': strategy or '',
+                    'limit': '' if limit is None else limit,
+                    'remaining': '' if remaining is None else remaining,
+                    'ts': ts
+                }, maxlen=LOG_STREAM_MAXLEN, approximate=True)
+            pipe.execute()
+        except redis.RedisError as e:
+            logger.error(f"Failed to write {len(rows)} request logs: {e}")
+
+
+threading.Thread(target=log_writer, name='log-writer', daemon=True).start()
 
 
 def rate_limit(limit: int = 100, window: int = 60, 
@@ -99,6 +179,10 @@ def rate_limit(limit: int = 100, window: int = 60,
         strategy: Rate limiting algorithm
     """
     def decorator(f):
+        # Header values that don't change per request
+        limit_header = str(limit)
+        strategy_header = strategy.label
+        
         @wraps(f)
         def decorated_function(*args, **kwargs):
             # Get client identifier (IP or API key)
@@ -118,43 +202,31 @@ def rate_limit(limit: int = 100, window: int = 60,
             # Log the request
             log_request(client_id, endpoint, allowed, metadata)
             
-            # Add rate limit headers
-            response_headers = {
-                'X-RateLimit-Limit': str(metadata.get('limit', limit)),
-                'X-RateLimit-Remaining': str(metadata.get('remaining', 0)),
-                'X-RateLimit-Reset': str(metadata.get('reset_at', 0)),
-                'X-RateLimit-Strategy': metadata.get('strategy', strategy.value),
-            }
-            
-            if metadata.get('fallback'):
-                response_headers['X-RateLimit-Fallback'] = 'true'
-            
             # Track performance metrics
             logger.info(f"Rate limit check took {check_duration*1000:.2f}ms for {client_id}")
             
-            if not allowed:
+            if allowed:
+                # Execute the route handler
+                response = make_response(f(*args, **kwargs))
+            else:
                 response = jsonify({
                     'error': 'Rate limit exceeded',
-                    'limit': metadata.get('limit'),
+                    'limit': limit,
                     'window': window,
                     'retry_after': metadata.get('reset_at', 0) - int(time.time())
                 })
                 response.status_code = 429
-                
-                for key, value in response_headers.items():
-                    response.headers[key] = value
-                
-                return response
-            
-            # Execute the route handler
-            result = f(*args, **kwargs)
             
-            # Add headers to successful response
-            if hasattr(result, 'headers'):
-                for key, value in response_headers.items():
-                    result.headers[key] = value
+            # Add rate limit headers
+            headers = response.headers
+            headers['X-RateLimit-Limit'] = limit_header
+            headers['X-RateLimit-Remaining'] = str(metadata.get('remaining', 0))
+            headers['X-RateLimit-Reset'] = str(metadata.get('reset_at', 0))
+            headers['X-RateLimit-Strategy'] = strategy_header
+            if metadata.get('fallback'):
+                headers['X-RateLimit-Fallback'] = 'true'
             
-            return result
+            return response
         
         return decorated_function
     return decorator
@@ -231,7 +303,7 @@ def metrics():
                 SUM(CASE WHEN allowed THEN 1 ELSE 0 END) as allowed_requests,
                 SUM(CASE WHEN NOT allowed THEN 1 ELSE 0 END) as blocked_requests
             FROM request_logs
-            WHERE timestamp > NOW() - INTERVAL '1 hour'
+            WHERE timestamp_epoch > EXTRACT(EPOCH FROM NOW())::bigint - 3600
         """)
         
         stats = cursor.fetchone()
@@ -2,10 +2,21 @@
 Simple admin dashboard for rate limiter analytics.
 """
 from flask import Flask, render_template_string, jsonify
+from cachetools import TTLCache
 import psycopg2
+import logging
 import os
+import threading
+import time
 from datetime import datetime, timedelta
 
+# Configure logging
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger(__name__)
+
 app = Flask(__name__)
 
 POSTGRES_HOST = os.getenv('POSTGRES_HOST', 'localhost')
@@ -13,6 +24,14 @@ POSTGRES_DB = os.getenv('POSTGRES_DB', 'ratelimiter')
 POSTGRES_USER = os.getenv('POSTGRES_USER', 'postgres')
 POSTGRES_PASSWORD = os.getenv('POSTGRES_PASSWORD', 'postgres')
 
+# How stale the request_logs_1m rollup may get before a refresh (seconds)
+STATS_REFRESH_INTERVAL = 15
+
+# Rendered dashboard and /api/stats payload are reused for this long (seconds)
+RESPONSE_CACHE_TTL = 5
+_response_cache = TTLCache(maxsize=2, ttl=RESPONSE_CACHE_TTL)
+_response_cache_lock = threading.Lock()
+
 
 def get_db():
     return psycopg2.connect(
@@ -23,6 +42,32 @@ def get_db():
     )
 
 
+_stats_refreshed_at = 0.0
+_stats_refresh_lock = threading.Lock()
+
+
+def refresh_minute_stats(db):
+    """Refresh the per-minute rollup if it is older than STATS_REFRESH_INTERVAL."""
+    global _stats_refreshed_at
+    if time.time() - _stats_refreshed_at < STATS_REFRESH_INTERVAL:
+        return
+    # Only one request refreshes; the others read the current rollup
+    if not _stats_refresh_lock.acquire(blocking=False):
+        return
+    try:
+        cursor = db.cursor()
+        cursor.execute("REFRESH MATERIALIZED VIEW CONCURRENTLY request_logs_1m")
+        db.commit()
+    except psycopg2.Error as e:
+        # Serve the current rollup; the next attempt waits a full interval
+        logger.warning(f"Could not refresh request_logs_1m: {e}")
+        if not db.closed:
+            db.rollback()
+    finally:
+        _stats_refreshed_at = time.time()
+        _stats_refresh_lock.release()
+
+
 DASHBOARD_HTML = """
 <!DOCTYPE html>
 <html>
@@ -197,6 +242,11 @@ DASHBOARD_HTML = """
 @app.route('/')
 def dashboard():
     """Main dashboard view."""
+    with _response_cache_lock:
+        html = _response_cache.get('html')
+    if html is not None:
+        return html
+    
     db = get_db()
     cursor = db.cursor()
     
@@ -207,7 +257,7 @@ def dashboard():
             SUM(CASE WHEN allowed THEN 1 ELSE 0 END) as allowed,
             SUM(CASE WHEN NOT allowed THEN 1 ELSE 0 END) as blocked
         FROM request_logs
-        WHERE timestamp > NOW() - INTERVAL '1 hour'
+        WHERE timestamp_epoch > EXTRACT(EPOCH FROM NOW())::bigint - 3600
     """)
     stats_row = cursor.fetchone()
     stats = {
@@ -227,42 +277,56 @@ def dashboard():
     
     db.close()
     
-    return render_template_string(
+    html = render_template_string(
         DASHBOARD_HTML,
         stats=stats,
         endpoint_stats=endpoint_stats,
         top_blocked=top_blocked
     )
+    with _response_cache_lock:
+        _response_cache['html'] = html
+    
+    return html
 
 
 @app.route('/api/stats')
 def api_stats():
     """JSON API for stats."""
-    db = get_db()
-    cursor = db.cursor()
+    with _response_cache_lock:
+        timeseries = _response_cache.get('stats')
+    if timeseries is not None:
+        return jsonify(timeseries)
     
-    cursor.execute("""
-        SELECT 
-            date_trunc('minute', timestamp) as minute,
-            COUNT(*) as total,
-            SUM(CASE WHEN allowed THEN 1 ELSE 0 END) as allowed,
-            SUM(CASE WHEN NOT allowed THEN 1 ELSE 0 END) as blocked
-        FROM request_logs
-        WHERE timestamp > NOW() - INTERVAL '1 hour'
-        GROUP BY date_trunc('minute', timestamp)
-        ORDER BY minute DESC
-    """)
-    
-    timeseries = []
-    for row in cursor.fetchall():
-        timeseries.append({
-            'timestamp': row[0].isoformat(),
-            'total': row[1],
-            'allowed': row[2],
-            'blocked': row[3]
-        })
+    db = get_db()
+    try:
+        refresh_minute_stats(db)
+        cursor = db.cursor()
+        
+        cursor.execute("""
+            SELECT 
+                minute,
+                SUM(total)::bigint as total,
+                SUM(allowed)::bigint as allowed,
+                SUM(blocked)::bigint as blocked
+            FROM request_logs_1m
+            WHERE minute > NOW() - INTERVAL '1 hour'
+            GROUP BY minute
+            ORDER BY minute DESC
+        """)
+        
+        timeseries = []
+        for row in cursor.fetchall():
+            timeseries.append({
+                'timestamp': row[0].isoformat(),
+                'total': row[1],
+                'allowed': row[2],
+                'blocked': row[3]
+            })
+    finally:
+        db.close()
     
-    db.close()
+    with _response_cache_lock:
+        _response_cache['stats'] = timeseries
     
     return jsonify(timeseries)
 
@@ -3,25 +3,192 @@ Rate limiting algorithms implementation.
 Supports Token Bucket and Sliding Window strategies.
 """
 import time
+import hashlib
 import redis
+import redis.asyncio
 import logging
-from typing import Tuple, Optional
-from enum import Enum
+import threading
+from typing import Callable, List, Tuple, Optional, Union
+from enum import IntEnum
 
 logger = logging.getLogger(__name__)
 
+# Max keys remembered as denied in-process (see RateLimiter._cached_denial)
+DENY_CACHE_SIZE = 10000
 
-class LimiterStrategy(Enum):
-    TOKEN_BUCKET = "token_bucket"
-    SLIDING_WINDOW = "sliding_window"
+# Max keys tracked by the in-process limiter used while Redis is down
+LOCAL_BUCKET_SIZE = 10000
+
+
+# Token bucket - allows bursts up to limit, refilling at a constant rate.
+# KEYS[1] = bucket key, ARGV = limit, window[, now]
+# Returns {allowed, remaining, retry_after_ms}
+TOKEN_BUCKET_LUA = """
+local key = KEYS[1]
+local limit = tonumber(ARGV[1])
+local window = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+if not now then
+    -- Redis's clock, so every gateway sees the same time
+    local t = redis.call('TIME')
+    now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+end
+
+local bucket = redis.call('HMGET', key, 'tokens', 'last_refill')
+local tokens = tonumber(bucket[1])
+local last_refill = tonumber(bucket[2])
+
+-- Initialize if doesn't exist
+if not tokens then
+    tokens = limit
+    last_refill = now
+end
+
+-- Calculate refill (fractional, so frequent calls don't lose refill progress)
+local elapsed = now - last_refill
+local refill_rate = limit / window
+
+tokens = math.min(limit, tokens + elapsed * refill_rate)
+last_refill = now
+
+local allowed = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+    allowed = 1
+end
+
+-- Update state
+redis.call('HSET', key, 'tokens', tokens, 'last_refill', last_refill)
+redis.call('EXPIRE', key, window * 2)
+
+-- Time until the next whole token is available
+local retry_after = 0
+if tokens < 1 then
+    retry_after = (1 - tokens) / refill_rate
+end
+
+return {allowed, math.floor(tokens), math.ceil(retry_after * 1000)}
+"""
+
+# Sliding window counter - weights the previous fixed window's count by its
+# overlap to approximate a true sliding window in constant memory.
+# KEYS[1] = window key, ARGV = limit, window[, now]
+# Returns {allowed, remaining, retry_after_ms}
+SLIDING_WINDOW_LUA = """
+local key = KEYS[1]
+local limit = tonumber(ARGV[1])
+local window = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+if not now then
+    -- Redis's clock, so every gateway sees the same time
+    local t = redis.call('TIME')
+    now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+end
+
+-- Fixed window this request falls in and how far into it we are
+local current = math.floor(now / window)
+local elapsed = now - current * window
+
+local state = redis.call('HMGET', key, 'window', 'count', 'previous')
+local stored = tonumber(state[1])
+local count = 0
+local previous = 0
+
+-- Roll the counters forward if the stored window is stale
+if stored == current then
+    count = tonumber(state[2])
+    previous = tonumber(state[3])
+elseif stored == current - 1 then
+    previous = tonumber(state[2])
+end
+
+-- Previous window counts in proportion to its overlap with the sliding window
+local weighted = previous * (1 - elapsed / window) + count
+
+local allowed = 0
+if weighted < limit then
+    count = count + 1
+    weighted = weighted + 1
+    redis.call('HSET', key, 'window', current, 'count', count, 'previous', previous)
+    redis.call('EXPIRE', key, window * 2)
+    allowed = 1
+end
+
+-- Time until the weighted count drops below the limit again
+local retry_after = 0
+if allowed == 0 then
+    if count < limit then
+        -- Enough of the previous window has to slide out
+        retry_after = window * (1 - (limit - count) / previous) - elapsed
+    else
+        -- Wait for the next window, then for this one to slide out far enough
+        retry_after = window - elapsed + window * (1 - limit / count)
+    end
+end
+
+return {allowed, math.max(0, math.floor(limit - weighted)), math.ceil(math.max(0, retry_after) * 1000)}
+"""
+
+
+def _script_sha(script: str) -> str:
+    """SHA1 digest Redis uses to identify a loaded Lua script."""
+    return hashlib.sha1(script.encode('utf-8')).hexdigest()
+
+
+class LimiterStrategy(IntEnum):
+    TOKEN_BUCKET = 1
+    SLIDING_WINDOW = 2
+    
+    def __init__(self, value):
+        # Name used in metadata, headers and request logs, e.g. "token_bucket"
+        self.label = self.name.lower()
 
 
 class RateLimiter:
     """Base rate limiter with Redis backend for distributed state."""
     
-    def __init__(self, redis_client: redis.Redis, fallback_mode: bool = True):
+    def __init__(self, redis_client: Union[redis.Redis, redis.ConnectionPool],
+                 fallback_mode: bool = True,
+                 time_fn: Optional[Callable[[], float]] = None,
+                 async_redis_client: Optional[redis.asyncio.Redis] = None):
+        """
+        Args:
+            redis_client: Redis client, or a connection pool to build one from
+            fallback_mode: Allow (True) or deny (False) requests when Redis fails
+            time_fn: Clock override passed to the scripts as `now`. By default
+                the scripts read Redis's own clock, so gateways with skewed
+                clocks still agree. Tests inject a fake clock; it then also
+                times the deny cache, which otherwise uses time.monotonic.
+            async_redis_client: redis.asyncio client for check_limit_async,
+                pointing at the same Redis as redis_client
+        """
+        if isinstance(redis_client, redis.ConnectionPool):
+            redis_client = redis.Redis(connection_pool=redis_client)
         self.redis = redis_client
+        self.async_redis = async_redis_client
         self.fallback_mode = fallback_mode
+        # Short-circuit to the fallback path while Redis keeps failing
+        self.breaker = CircuitBreaker(redis_client, failure_threshold=5, timeout=30)
+        self._tb_sha = _script_sha(TOKEN_BUCKET_LUA)
+        self._sw_sha = _script_sha(SLIDING_WINDOW_LUA)
+        # Per-strategy (script, sha, key prefix), resolved once here
+        self._scripts = {
+            LimiterStrategy.TOKEN_BUCKET: (TOKEN_BUCKET_LUA, self._tb_sha, "bucket:"),
+            # Sliding-window counters are hashes; the old "window:" keys were
+            # ZSETs, so a new prefix avoids WRONGTYPE during rolling upgrades
+            LimiterStrategy.SLIDING_WINDOW: (SLIDING_WINDOW_LUA, self._sw_sha, "swc:"),
+        }
+        # Local time is only used for metadata unless a clock was injected
+        self._now = time_fn or time.time
+        self._send_now = time_fn is not None
+        self._deny_clock = time_fn or time.monotonic
+        # Redis key -> (deny_until, metadata) for keys known to be blocked
+        self._deny_cache = {}
+        # Writers and eviction are serialised; lookups stay lock-free
+        self._deny_lock = threading.Lock()
+        # Per-process limits enforced while Redis is unreachable (fail open)
+        self._local = LocalTokenBucket(self._deny_clock)
+        self._preload_scripts()
     
     def check_limit(self, key: str, limit: int, window: int, strategy: LimiterStrategy) -> Tuple[bool, dict]:
         """
@@ -36,127 +203,254 @@ class RateLimiter:
         Returns:
             Tuple of (allowed: bool, metadata: dict)
         """
+        script, sha, prefix = self._script_for(strategy)
+        now = self._now()
+        redis_key = prefix + key
+        cached = self._cached_denial(redis_key, now)
+        if cached is not None:
+            return False, cached
+        
         try:
-            if strategy == LimiterStrategy.TOKEN_BUCKET:
-                return self._token_bucket(key, limit, window)
-            elif strategy == LimiterStrategy.SLIDING_WINDOW:
-                return self._sliding_window(key, limit, window)
-            else:
-                raise ValueError(f"Unknown strategy: {strategy}")
+            result = self.breaker.call(
+                self._evalsha, script, sha, redis_key,
+                *self._script_args(limit, window, now)
+            )
         except redis.RedisError as e:
             logger.error(f"Redis error in rate limiter: {e}")
-            if self.fallback_mode:
-                # Fail open - allow request but log the failure
-                logger.warning(f"Rate limiter failed open for key: {key}")
-                return True, {"fallback": True, "error": str(e)}
-            else:
-                # Fail closed - deny request on Redis failure
-                return False, {"fallback": True, "error": str(e)}
+            return self._fallback(key, limit, window, strategy, e)
+        return self._parse_result(strategy, redis_key, result, limit, window, now)
     
-    def _token_bucket(self, key: str, limit: int, window: int) -> Tuple[bool, dict]:
+    async def check_limit_async(self, key: str, limit: int, window: int,
+                                strategy: LimiterStrategy) -> Tuple[bool, dict]:
         """
-        Token bucket algorithm - allows burst traffic up to capacity.
-        Tokens refill at a constant rate.
+        check_limit for asyncio callers, using the async Redis client.
+        
+        Concurrent calls overlap their Redis round trips instead of each
+        blocking a thread. Shares the deny cache, circuit breaker and
+        fallback with the sync path.
         """
-        lua_script = """
-        local key = KEYS[1]
-        local limit = tonumber(ARGV[1])
-        local window = tonumber(ARGV[2])
-        local now = tonumber(ARGV[3])
+        if self.async_redis is None:
+            raise RuntimeError("check_limit_async needs an async_redis_client")
+        script, sha, prefix = self._script_for(strategy)
+        now = self._now()
+        redis_key = prefix + key
+        cached = self._cached_denial(redis_key, now)
+        if cached is not None:
+            return False, cached
         
-        local bucket = redis.call('HMGET', key, 'tokens', 'last_refill')
-        local tokens = tonumber(bucket[1])
-        local last_refill = tonumber(bucket[2])
+        try:
+            result = await self.breaker.call_async(
+                self._evalsha_async, script, sha, redis_key,
+                *self._script_args(limit, window, now)
+            )
+        except redis.RedisError as e:
+            logger.error(f"Redis error in rate limiter: {e}")
+            return self._fallback(key, limit, window, strategy, e)
+        return self._parse_result(strategy, redis_key, result, limit, window, now)
+    
+    def check_limit_many(self, items: List[Tuple[str, int, int, LimiterStrategy]]) -> List[Tuple[bool, dict]]:
+        """
+        Check several requests in a single Redis round trip.
         
-        -- Initialize if doesn't exist
-        if not tokens then
-            tokens = limit
-            last_refill = now
-        end
+        Args:
+            items: (key, limit, window, strategy) per request, applied in order
+            
+        Returns:
+            List of (allowed: bool, metadata: dict), one per item
+        """
+        now = self._now()
+        results = [None] * len(items)
+        calls = []  # (index, script, sha, redis_key, limit, window, strategy)
+        for i, (key, limit, window, strategy) in enumerate(items):
+            script, sha, prefix = self._script_for(strategy)
+            redis_key = prefix + key
+            cached = self._cached_denial(redis_key, now)
+            if cached is not None:
+                results[i] = (False, cached)
+            else:
+                calls.append((i, script, sha, redis_key, limit, window, strategy))
         
-        -- Calculate refill
-        local elapsed = now - last_refill
-        local refill_rate = limit / window
-        local tokens_to_add = math.floor(elapsed * refill_rate)
+        if not calls:
+            return results
         
-        tokens = math.min(limit, tokens + tokens_to_add)
-        last_refill = now
+        try:
+            replies = self.breaker.call(self._evalsha_many, calls, now)
+        except redis.RedisError as e:
+            logger.error(f"Redis error in rate limiter: {e}")
+            for i, *_ in calls:
+                results[i] = self._fallback(*items[i], e)
+            return results
         
-        local allowed = 0
-        if tokens >= 1 then
-            tokens = tokens - 1
-            allowed = 1
-        end
+        for (i, _, _, redis_key, limit, window, strategy), reply in zip(calls, replies):
+            results[i] = self._parse_result(strategy, redis_key, reply, limit, window, now)
+        return results
+    
+    def _fallback(self, key: str, limit: int, window: int, strategy: LimiterStrategy,
+                  error: Exception) -> Tuple[bool, dict]:
+        """Answer for a request Redis couldn't check."""
+        if self.fallback_mode:
+            # Fail open - enforce the limit per process instead of globally
+            logger.warning(f"Rate limiter failed open for key: {key}")
+            allowed, tokens, retry_after = self._local.check(
+                self._scripts[strategy][2] + key, limit, window
+            )
+            return allowed, {
+                "strategy": strategy.label,
+                "limit": limit,
+                "remaining": int(tokens),
+                "window": window,
+                "reset_at": int(self._now() + window),
+                "retry_after": retry_after,
+                "fallback": True,
+                "local": True,
+                "error": str(error)
+            }
+        else:
+            # Fail closed - deny request on Redis failure
+            return False, {"fallback": True, "error": str(error)}
+    
+    def _script_for(self, strategy: LimiterStrategy) -> Tuple[str, str, str]:
+        """(script, sha, key prefix) implementing a strategy."""
+        try:
+            return self._scripts[strategy]
+        except KeyError:
+            raise ValueError(f"Unknown strategy: {strategy}") from None
+    
+    def _preload_scripts(self):
+        """Load the Lua scripts up front so the first checks don't hit NOSCRIPT."""
+        try:
+            self.redis.script_load(TOKEN_BUCKET_LUA)
+            self.redis.script_load(SLIDING_WINDOW_LUA)
+        except redis.RedisError as e:
+            # Not fatal: _evalsha loads scripts on demand once Redis is back
+            logger.warning(f"Could not preload rate limit scripts: {e}")
+    
+    def _evalsha(self, script: str, sha: str, key: str, *args):
+        """Run a cached script by SHA, loading it first if Redis doesn't have it."""
+        try:
+            return self.redis.evalsha(sha, 1, key, *args)
+        except redis.exceptions.NoScriptError:
+            self.redis.script_load(script)
+            return self.redis.evalsha(sha, 1, key, *args)
+    
+    async def _evalsha_async(self, script: str, sha: str, key: str, *args):
+        """Async _evalsha: run a cached script, loading it first if Redis doesn't have it."""
+        try:
+            return await self.async_redis.evalsha(sha, 1, key, *args)
+        except redis.exceptions.NoScriptError:
+            await self.async_redis.script_load(script)
+            return await self.async_redis.evalsha(sha, 1, key, *args)
+    
+    def _script_args(self, limit: int, window: int, now: float) -> tuple:
+        """ARGV for the scripts; `now` is only sent when a clock was injected."""
+        if self._send_now:
+            return limit, window, now
+        return limit, window
+    
+    def _evalsha_many(self, calls: list, now: float) -> list:
+        """Run a batch of cached scripts in one pipeline, resending only NOSCRIPT failures."""
+        pipe = self.redis.pipeline(transaction=False)
+        for _, _, sha, redis_key, limit, window, _ in calls:
+            pipe.evalsha(sha, 1, redis_key, *self._script_args(limit, window, now))
+        replies = pipe.execute(raise_on_error=False)
         
-        -- Update state
-        redis.call('HMSET', key, 'tokens', tokens, 'last_refill', last_refill)
-        redis.call('EXPIRE', key, window * 2)
+        missing = [n for n, reply in enumerate(replies)
+                   if isinstance(reply, redis.exceptions.NoScriptError)]
+        if missing:
+            for script in {calls[n][1] for n in missing}:
+                self.redis.script_load(script)
+            pipe = self.redis.pipeline(transaction=False)
+            for n in missing:
+                _, _, sha, redis_key, limit, window, _ = calls[n]
+                pipe.evalsha(sha, 1, redis_key, *self._script_args(limit, window, now))
+            for n, reply in zip(missing, pipe.execute(raise_on_error=False)):
+                replies[n] = reply
         
-        return {allowed, tokens, limit}
+        for reply in replies:
+            if isinstance(reply, Exception):
+                raise reply
+        return replies
+    
+    def _seed(self, key: str, limit: int, window: int, strategy: LimiterStrategy, used: int):
         """
+        Write the state left by `used` allowed requests in one pipeline.
         
-        now = time.time()
-        result = self.redis.eval(lua_script, 1, f"bucket:{key}", limit, window, now)
-        
-        allowed = bool(result[0])
-        remaining = int(result[1])
-        
-        metadata = {
-            "strategy": "token_bucket",
-            "limit": limit,
-            "remaining": remaining,
-            "window": window,
-            "reset_at": int(now + window)
-        }
-        
-        return allowed, metadata
-    
-    def _sliding_window(self, key: str, limit: int, window: int) -> Tuple[bool, dict]:
+        For tests that only care about the end state, instead of making
+        `used` separate check_limit calls.
         """
-        Sliding window algorithm - more accurate than fixed window,
-        prevents boundary issues.
+        _, _, prefix = self._script_for(strategy)
+        now = self._now()
+        redis_key = prefix + key
+        state = {
+            LimiterStrategy.TOKEN_BUCKET: {"tokens": limit - used, "last_refill": now},
+            LimiterStrategy.SLIDING_WINDOW: {"window": int(now // window), "count": used, "previous": 0},
+        }[strategy]
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.hset(redis_key, mapping=state)
+        pipe.expire(redis_key, window * 2)
+        pipe.execute()
+    
+    def _cached_denial(self, redis_key: str, now: float) -> Optional[dict]:
         """
-        lua_script = """
-        local key = KEYS[1]
-        local limit = tonumber(ARGV[1])
-        local window = tonumber(ARGV[2])
-        local now = tonumber(ARGV[3])
-        
-        -- Remove old entries outside the window
-        redis.call('ZREMRANGEBYSCORE', key, 0, now - window)
+        Metadata for a key Redis already blocked, if the block hasn't run out.
         
-        -- Count requests in current window
-        local count = redis.call('ZCARD', key)
-        
-        local allowed = 0
-        if count < limit then
-            -- Add current request
-            redis.call('ZADD', key, now, now)
-            redis.call('EXPIRE', key, window)
-            allowed = 1
-            count = count + 1
-        end
-        
-        return {allowed, limit - count, limit}
+        A blocked request changes no state in Redis and other gateways can only
+        add to the count, so until retry_after passes the answer is known
+        without a round trip.
         """
-        
-        now = time.time()
-        result = self.redis.eval(lua_script, 1, f"window:{key}", limit, window, now)
-        
+        entry = self._deny_cache.get(redis_key)
+        if entry is None:
+            return None
+        deny_until, metadata = entry
+        # Monotonic by default, so a wall clock step can't stretch or cut short a block
+        left = deny_until - self._deny_clock()
+        if left <= 0:
+            self._deny_cache.pop(redis_key, None)
+            return None
+        return dict(metadata, reset_at=int(now + metadata["window"]), retry_after=left, cached=True)
+    
+    def _remember_denial(self, redis_key: str, metadata: dict):
+        """Cache a block from Redis until its retry_after runs out."""
+        if metadata["retry_after"] <= 0:
+            return
+        clock_now = self._deny_clock()
+        cache = self._deny_cache
+        with self._deny_lock:
+            if len(cache) >= DENY_CACHE_SIZE:
+                # Drop expired entries; start over if everything is still live.
+                # Iterate a snapshot: _cached_denial pops without the lock.
+                for k, (until, _) in list(cache.items()):
+                    if until <= clock_now:
+                        cache.pop(k, None)
+                if len(cache) >= DENY_CACHE_SIZE:
+                    cache.clear()
+            cache[redis_key] = (clock_now + metadata["retry_after"], metadata)
+    
+    def _parse_result(self, strategy: LimiterStrategy, redis_key: str, result: list,
+                      limit: int, window: int, now: float) -> Tuple[bool, dict]:
+        """Turn a script's {allowed, remaining, retry_after_ms} reply into (allowed, metadata)."""
         allowed = bool(result[0])
         remaining = int(result[1])
+        retry_after = int(result[2]) / 1000
         
         metadata = {
-            "strategy": "sliding_window",
+            "strategy": strategy.label,
             "limit": limit,
             "remaining": remaining,
             "window": window,
-            "reset_at": int(now + window)
+            "reset_at": int(now + window),
+            "retry_after": retry_after
         }
         
+        if not allowed:
+            self._remember_denial(redis_key, metadata)
         return allowed, metadata
 
 
+class CircuitOpenError(redis.RedisError):
+    """Raised instead of calling Redis while the circuit breaker is open."""
+
+
 class CircuitBreaker:
     """
     Circuit breaker for Redis failures.
@@ -175,26 +469,84 @@ class CircuitBreaker:
     
     def call(self, func, *args, **kwargs):
         """Execute function with circuit breaker protection."""
+        self._before_call()
+        try:
+            result = func(*args, **kwargs)
+        except Exception:
+            self._record_failure()
+            raise
+        self._record_success()
+        return result
+    
+    async def call_async(self, func, *args, **kwargs):
+        """Await a coroutine function with circuit breaker protection."""
+        self._before_call()
+        try:
+            result = await func(*args, **kwargs)
+        except Exception:
+            self._record_failure()
+            raise
+        self._record_success()
+        return result
+    
+    def _before_call(self):
+        """Refuse the call while open, or let one through once the timeout has passed."""
         if self.state == "open":
-            if time.time() - self.last_failure_time > self.timeout:
+            if time.monotonic() - self.last_failure_time > self.timeout:
                 self.state = "half_open"
                 logger.info("Circuit breaker entering half-open state")
             else:
-                raise Exception("Circuit breaker is open")
+                raise CircuitOpenError("Circuit breaker is open")
+    
+    def _record_success(self):
+        """Close a half-open circuit and reset the failure streak."""
+        if self.state == "half_open":
+            self.state = "closed"
+            logger.info("Circuit breaker closed")
+        # Only consecutive failures should open the circuit
+        self.failures = 0
+    
+    def _record_failure(self):
+        """Count a failure and open the circuit at the threshold."""
+        self.failures += 1
+        self.last_failure_time = time.monotonic()
         
-        try:
-            result = func(*args, **kwargs)
-            if self.state == "half_open":
-                self.state = "closed"
-                self.failures = 0
-                logger.info("Circuit breaker closed")
-            return result
-        except Exception as e:
-            self.failures += 1
-            self.last_failure_time = time.time()
-            
-            if self.failures >= self.failure_threshold:
-                self.state = "open"
-                logger.error(f"Circuit breaker opened after {self.failures} failures")
-            
-            raise e
+        if self.failures >= self.failure_threshold:
+            self.state = "open"
+            logger.error(f"Circuit breaker opened after {self.failures} failures")
+
+
+class LocalTokenBucket:
+    """
+    In-memory token bucket used in place of Redis while it is unreachable.
+    
+    Limits are per gateway process rather than global, so this is looser
+    than the Redis-backed strategies, but a single client still can't
+    flood the backend through a Redis outage.
+    """
+    
+    def __init__(self, clock: Callable[[], float], max_keys: int = LOCAL_BUCKET_SIZE):
+        self.clock = clock
+        self.max_keys = max_keys
+        self.buckets = {}  # key -> (tokens, last_refill)
+        self.lock = threading.Lock()
+    
+    def check(self, key: str, limit: int, window: int) -> Tuple[bool, float, float]:
+        """Take a token if one is available; returns (allowed, tokens left, retry_after)."""
+        now = self.clock()
+        refill_rate = limit / window
+        with self.lock:
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                if len(self.buckets) >= self.max_keys:
+                    # Outages are short; forgetting every client is an acceptable bound
+                    self.buckets.clear()
+                tokens = limit
+            else:
+                tokens = min(limit, bucket[0] + (now - bucket[1]) * refill_rate)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            self.buckets[key] = (tokens, now)
+        retry_after = 0.0 if tokens >= 1 else (1 - tokens) / refill_rate
+        return allowed, tokens, retry_after
@@ -0,0 +1,182 @@
+"""
+Request log consumer.
+Tails the gateway's Redis stream and bulk-inserts request logs into PostgreSQL.
+"""
+import redis
+import psycopg2
+from psycopg2.extras import execute_values
+import logging
+import os
+import socket
+import time
+
+# Configure logging
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger(__name__)
+
+# Configuration
+REDIS_HOST = os.getenv('REDIS_HOST', 'localhost')
+REDIS_PORT = int(os.getenv('REDIS_PORT', 6379))
+POSTGRES_HOST = os.getenv('POSTGRES_HOST', 'localhost')
+POSTGRES_DB = os.getenv('POSTGRES_DB', 'ratelimiter')
+POSTGRES_USER = os.getenv('POSTGRES_USER', 'postgres')
+POSTGRES_PASSWORD = os.getenv('POSTGRES_PASSWORD', 'postgres')
+
+LOG_STREAM = os.getenv('LOG_STREAM', 'request_logs')
+CONSUMER_GROUP = 'ingest'
+CONSUMER_NAME = os.getenv('CONSUMER_NAME', socket.gethostname())
+BATCH_SIZE = 1000
+BLOCK_MS = 1000
+PARTITION_CHECK_INTERVAL = 3600  # seconds
+RETRY_DELAY = 2  # seconds
+# Column widths from config/schema.sql
+TEXT_WIDTH = 255
+STRATEGY_WIDTH = 50
+
+
+def _nullable_int(value: str):
+    return int(value) if value else None
+
+
+def _text(value: str, width: int) -> str:
+    # Client-supplied (X-API-Key, path), so make it fit the column: Postgres
+    # rejects NUL bytes and over-long values outright
+    return value.replace('\x00', '')[:width]
+
+
+def to_row(fields: dict) -> tuple:
+    """Convert a stream entry written by the gateway into a request_logs row."""
+    return (
+        _text(fields['client_id'], TEXT_WIDTH),
+        _text(fields['endpoint'], TEXT_WIDTH),
+        fields['allowed'] == '1',
+        _text(fields['strategy'], STRATEGY_WIDTH) or None,
+        _nullable_int(fields['limit']),
+        _nullable_int(fields['remaining']),
+        int(fields['ts'])
+    )
+
+
+def ensure_group(redis_client: redis.Redis):
+    """Create the consumer group (and stream) if they don't exist yet."""
+    try:
+        redis_client.xgroup_create(LOG_STREAM, CONSUMER_GROUP, id='0', mkstream=True)
+    except redis.ResponseError as e:
+        if 'BUSYGROUP' not in str(e):
+            raise
+
+
+def to_rows(entries: list) -> list:
+    """Convert a batch of stream entries, skipping trimmed or malformed ones."""
+    rows = []
+    for entry_id, fields in entries:
+        if not fields:
+            # Pending entry trimmed by MAXLEN (or deleted) before we got to it
+            logger.warning(f"Skipping log entry {entry_id} with no fields")
+            continue
+        try:
+            rows.append(to_row(fields))
+        except (KeyError, TypeError, ValueError) as e:
+            logger.warning(f"Skipping malformed log entry {entry_id}: {e!r}")
+    return rows
+
+
+INSERT_SQL = """
+    INSERT INTO request_logs
+    (client_id, endpoint, allowed, strategy, limit_value, remaining, timestamp_epoch)
+    VALUES %s
+"""
+
+
+def write_batch(db, entries: list):
+    """
+    Insert one batch of stream entries in a single transaction.
+    
+    If Postgres rejects the batch because of its data, the rows are retried
+    one at a time and the ones it still rejects are dropped, so a single
+    poison entry can't hold up the stream.
+    """
+    rows = to_rows(entries)
+    if not rows:
+        return
+    try:
+        with db.cursor() as cursor:
+            execute_values(cursor, INSERT_SQL, rows, page_size=BATCH_SIZE)
+        db.commit()
+        return
+    except (psycopg2.DataError, ValueError) as e:
+        # ValueError: a value psycopg2 can't adapt; nothing was sent
+        db.rollback()
+        logger.warning(f"Batch of {len(rows)} rejected, inserting row by row: {e!r}")
+    
+    for row in rows:
+        try:
+            with db.cursor() as cursor:
+                execute_values(cursor, INSERT_SQL, [row])
+            db.commit()
+        except (psycopg2.DataError, ValueError) as e:
+            db.rollback()
+            logger.warning(f"Dropping log row rejected by PostgreSQL {row!r}: {e!r}")
+
+
+def run():
+    """Consume the stream forever, acking entries only after they are committed."""
+    redis_client = redis.Redis(host=REDIS_HOST, port=REDIS_PORT, decode_responses=True)
+    db = None
+    partitions_checked_at = None
+    group_ready = False
+    # Start with entries delivered to us before a restart but never acked
+    stream_id = '0'
+
+    while True:
+        try:
+            # Once at startup, and again after Redis errors (e.g. stream deleted)
+            if not group_ready:
+                ensure_group(redis_client)
+                group_ready = True
+            if db is None or db.closed:
+                db = psycopg2.connect(
+                    host=POSTGRES_HOST,
+                    database=POSTGRES_DB,
+                    user=POSTGRES_USER,
+                    password=POSTGRES_PASSWORD
+                )
+                partitions_checked_at = None
+
+            # Keep monthly partitions created ahead of the inserts
+            if (partitions_checked_at is None
+                    or time.monotonic() - partitions_checked_at > PARTITION_CHECK_INTERVAL):
+                with db.cursor() as cursor:
+                    cursor.execute("SELECT create_request_logs_partitions()")
+                db.commit()
+                partitions_checked_at = time.monotonic()
+
+            response = redis_client.xreadgroup(
+                CONSUMER_GROUP, CONSUMER_NAME, {LOG_STREAM: stream_id},
+                count=BATCH_SIZE, block=BLOCK_MS
+            )
+            entries = response[0][1] if response else []
+            if not entries:
+                # Pending backlog drained; switch to new entries
+                stream_id = '>'
+                continue
+
+            write_batch(db, entries)
+            redis_client.xack(LOG_STREAM, CONSUMER_GROUP, *[entry_id for entry_id, _ in entries])
+        except (redis.RedisError, psycopg2.Error) as e:
+            logger.error(f"Log consumer error, retrying in {RETRY_DELAY}s: {e}")
+            if isinstance(e, redis.RedisError):
+                group_ready = False
+            if db is not None:
+                db.close()
+                db = None
+            # Re-read anything delivered but not yet acked
+            stream_id = '0'
+            time.sleep(RETRY_DELAY)
+
+
+if __name__ == '__main__':
+    run()
@@ -2,29 +2,54 @@
 Tests for rate limiter functionality.
 """
 import unittest
+import asyncio
 import time
 from unittest.mock import Mock, patch
 import redis
+import redis.asyncio
+from werkzeug.test import EnvironBuilder
 
 import sys
 sys.path.insert(0, '../src')
 
 from limiters import RateLimiter, LimiterStrategy
 
+# Shared by every test so sockets are reused instead of reconnecting per test
+POOL = redis.ConnectionPool(host='localhost', port=6379, max_connections=32)
+
+# Deletes every key matching ARGV[1] in one round trip (test namespace is tiny)
+_CLEANUP_LUA = "for _,k in ipairs(redis.call('KEYS', ARGV[1])) do redis.call('DEL', k) end"
+
+
+class FakeClock:
+    """Clock the tests advance by hand instead of sleeping."""
+    
+    def __init__(self):
+        self.time = time.time()
+    
+    def now(self) -> float:
+        return self.time
+    
+    def advance(self, seconds: float):
+        self.time += seconds
+
 
 class TestRateLimiter(unittest.TestCase):
     """Test rate limiting algorithms."""
     
-    def setUp(self):
-        """Set up test Redis client."""
-        self.redis_client = redis.Redis(host='localhost', port=6379, decode_responses=True)
-        self.limiter = RateLimiter(self.redis_client)
+    @classmethod
+    def setUpClass(cls):
+        """Set up test Redis client and clear keys left by earlier runs."""
+        cls.redis_client = redis.Redis(connection_pool=POOL)
         
-        # Clean up test keys
-        for key in self.redis_client.scan_iter("bucket:test_*"):
-            self.redis_client.delete(key)
-        for key in self.redis_client.scan_iter("window:test_*"):
-            self.redis_client.delete(key)
+        # Once per class is enough: every test uses its own client key
+        cls.redis_client.eval(_CLEANUP_LUA, 0, "bucket:test_*")
+        cls.redis_client.eval(_CLEANUP_LUA, 0, "swc:test_*")
+    
+    def setUp(self):
+        """Set up a limiter on a fresh fake clock."""
+        self.clock = FakeClock()
+        self.limiter = RateLimiter(self.redis_client, time_fn=self.clock.now)
     
     def test_token_bucket_allows_initial_requests(self):
         """Test that token bucket allows requests up to limit."""
@@ -45,8 +70,7 @@ class TestRateLimiter(unittest.TestCase):
         limit = 3
         
         # Use up all tokens
-        for _ in range(limit):
-            self.limiter.check_limit("test_client_2", limit, 60, LimiterStrategy.TOKEN_BUCKET)
+        self.limiter._seed("test_client_2", limit, 60, LimiterStrategy.TOKEN_BUCKET, used=limit)
         
         # Next request should be blocked
         allowed, metadata = self.limiter.check_limit(
@@ -55,21 +79,51 @@ class TestRateLimiter(unittest.TestCase):
         self.assertFalse(allowed)
         self.assertEqual(metadata['remaining'], 0)
     
+    def test_blocked_request_reports_retry_after(self):
+        """Test that a blocked request says how long until the next token."""
+        limit = 3
+        window = 60  # one token every 20 seconds
+        
+        self.limiter._seed("test_client_retry", limit, window, LimiterStrategy.TOKEN_BUCKET, used=limit)
+        
+        allowed, metadata = self.limiter.check_limit(
+            "test_client_retry", limit, window, LimiterStrategy.TOKEN_BUCKET
+        )
+        self.assertFalse(allowed)
+        self.assertGreater(metadata['retry_after'], 0)
+        self.assertLessEqual(metadata['retry_after'], window / limit)
+    
+    def test_blocked_key_skips_redis_until_retry_after(self):
+        """Test that repeat requests from a blocked client are denied locally."""
+        limit = 3
+        
+        for _ in range(limit + 1):
+            self.limiter.check_limit("test_client_8", limit, 60, LimiterStrategy.SLIDING_WINDOW)
+        
+        with patch.object(self.limiter.redis, 'evalsha') as evalsha:
+            allowed, metadata = self.limiter.check_limit(
+                "test_client_8", limit, 60, LimiterStrategy.SLIDING_WINDOW
+            )
+        evalsha.assert_not_called()
+        self.assertFalse(allowed)
+        self.assertEqual(metadata['remaining'], 0)
+        self.assertTrue(metadata['cached'])
+        self.assertGreater(metadata['retry_after'], 0)
+    
     def test_token_bucket_refills_over_time(self):
         """Test that token bucket refills tokens over time."""
         limit = 10
         window = 10  # 10 second window, so 1 token per second
         
         # Use up all tokens
-        for _ in range(limit):
-            self.limiter.check_limit("test_client_3", limit, window, LimiterStrategy.TOKEN_BUCKET)
+        self.limiter._seed("test_client_3", limit, window, LimiterStrategy.TOKEN_BUCKET, used=limit)
         
         # Should be blocked immediately
         allowed, _ = self.limiter.check_limit("test_client_3", limit, window, LimiterStrategy.TOKEN_BUCKET)
         self.assertFalse(allowed)
         
         # Wait for tokens to refill (2 seconds = 2 tokens)
-        time.sleep(2)
+        self.clock.advance(2)
         
         # Should allow 2 requests now
         for i in range(2):
@@ -97,8 +151,7 @@ class TestRateLimiter(unittest.TestCase):
         limit = 3
         
         # Use up limit
-        for _ in range(limit):
-            self.limiter.check_limit("test_client_5", limit, 60, LimiterStrategy.SLIDING_WINDOW)
+        self.limiter._seed("test_client_5", limit, 60, LimiterStrategy.SLIDING_WINDOW, used=limit)
         
         # Next request should be blocked
         allowed, metadata = self.limiter.check_limit(
@@ -112,16 +165,15 @@ class TestRateLimiter(unittest.TestCase):
         limit = 3
         window = 2  # 2 second window
         
-        # Make 3 requests
-        for _ in range(limit):
-            self.limiter.check_limit("test_client_6", limit, window, LimiterStrategy.SLIDING_WINDOW)
+        # Use up limit
+        self.limiter._seed("test_client_6", limit, window, LimiterStrategy.SLIDING_WINDOW, used=limit)
         
         # Should be blocked
         allowed, _ = self.limiter.check_limit("test_client_6", limit, window, LimiterStrategy.SLIDING_WINDOW)
         self.assertFalse(allowed)
         
-        # Wait for window to pass
-        time.sleep(window + 0.5)
+        # Wait for the window and the previous window weighted into it to pass
+        self.clock.advance(2 * window + 0.5)
         
         # Should allow new requests
         allowed, metadata = self.limiter.check_limit(
@@ -136,32 +188,128 @@ class TestRateLimiter(unittest.TestCase):
         
         # Client 1 uses up limit
         for _ in range(limit):
-            self.limiter.check_limit("client_a", limit, 60, LimiterStrategy.SLIDING_WINDOW)
+            self.limiter.check_limit("test_client_a", limit, 60, LimiterStrategy.SLIDING_WINDOW)
         
         # Client 1 should be blocked
-        allowed, _ = self.limiter.check_limit("client_a", limit, 60, LimiterStrategy.SLIDING_WINDOW)
+        allowed, _ = self.limiter.check_limit("test_client_a", limit, 60, LimiterStrategy.SLIDING_WINDOW)
         self.assertFalse(allowed)
         
         # Client 2 should still be allowed
-        allowed, metadata = self.limiter.check_limit("client_b", limit, 60, LimiterStrategy.SLIDING_WINDOW)
+        allowed, metadata = self.limiter.check_limit("test_client_b", limit, 60, LimiterStrategy.SLIDING_WINDOW)
         self.assertTrue(allowed)
         self.assertEqual(metadata['remaining'], limit - 1)
     
+    def test_scripts_preloaded_on_init(self):
+        """Test that creating a limiter (here from a bare pool) loads both Lua scripts."""
+        self.redis_client.script_flush()
+        limiter = RateLimiter(POOL)
+        
+        self.assertEqual(
+            self.redis_client.script_exists(limiter._tb_sha, limiter._sw_sha),
+            [True, True]
+        )
+    
+    def test_reloads_scripts_after_script_flush(self):
+        """Test that EVALSHA recovers when Redis has dropped its script cache."""
+        self.redis_client.script_flush()
+        
+        allowed, metadata = self.limiter.check_limit(
+            "test_client_7", 5, 60, LimiterStrategy.TOKEN_BUCKET
+        )
+        self.assertTrue(allowed)
+        self.assertFalse(metadata.get('fallback', False))
+        self.assertEqual(metadata['remaining'], 4)
+    
+    def test_scripts_use_redis_clock_by_default(self):
+        """Test that without an injected clock, `now` is not sent to Redis."""
+        limiter = RateLimiter(self.redis_client)
+        
+        with patch.object(limiter.redis, 'evalsha', wraps=limiter.redis.evalsha) as evalsha:
+            allowed, metadata = limiter.check_limit(
+                "test_client_9", 5, 60, LimiterStrategy.SLIDING_WINDOW
+            )
+        self.assertTrue(allowed)
+        self.assertEqual(metadata['remaining'], 4)
+        self.assertEqual(evalsha.call_args.args[3:], (5, 60))
+    
+    def test_check_limit_many_in_one_pipeline(self):
+        """Test that a batch is checked in order, reloading scripts Redis dropped."""
+        limit = 3
+        self.redis_client.script_flush()
+        
+        results = self.limiter.check_limit_many(
+            [("test_client_batch", limit, 60, LimiterStrategy.SLIDING_WINDOW)] * 5
+            + [("test_client_batch", limit, 60, LimiterStrategy.TOKEN_BUCKET)]
+        )
+        
+        self.assertEqual([allowed for allowed, _ in results], [True, True, True, False, False, True])
+        self.assertEqual([metadata['remaining'] for _, metadata in results], [2, 1, 0, 0, 0, 2])
+        self.assertFalse(any(metadata.get('fallback') for _, metadata in results))
+    
+    def test_check_limit_async_concurrent_requests(self):
+        """Test that concurrent async checks share one limit."""
+        limit = 3
+        
+        async def run():
+            async_client = redis.asyncio.Redis(host='localhost', port=6379)
+            limiter = RateLimiter(self.redis_client, time_fn=self.clock.now,
+                                  async_redis_client=async_client)
+            try:
+                return await asyncio.gather(*(
+                    limiter.check_limit_async("test_client_async", limit, 60, LimiterStrategy.SLIDING_WINDOW)
+                    for _ in range(5)
+                ))
+            finally:
+                await async_client.aclose()
+        
+        results = asyncio.run(run())
+        self.assertEqual(sum(allowed for allowed, _ in results), limit)
+        self.assertFalse(any(metadata.get('fallback') for _, metadata in results))
+    
     def test_fallback_mode_on_redis_failure(self):
         """Test that fallback mode handles Redis failures gracefully."""
         # Create limiter with mocked Redis that always fails
         mock_redis = Mock()
-        mock_redis.eval.side_effect = redis.RedisError("Connection failed")
+        mock_redis.script_load.side_effect = redis.RedisError("Connection failed")
+        mock_redis.evalsha.side_effect = redis.RedisError("Connection failed")
         
         limiter_with_fallback = RateLimiter(mock_redis, fallback_mode=True)
         
-        # Should fail open (allow request)
+        # Should fail open to the in-process limiter
+        for i in range(3):
+            allowed, metadata = limiter_with_fallback.check_limit(
+                "test_fallback", 3, 60, LimiterStrategy.SLIDING_WINDOW
+            )
+            self.assertTrue(allowed)
+            self.assertTrue(metadata.get('fallback'))
+            self.assertTrue(metadata.get('local'))
+            self.assertIn('error', metadata)
+            self.assertEqual(metadata['remaining'], 3 - i - 1)
+        
+        # ...which still enforces the limit
         allowed, metadata = limiter_with_fallback.check_limit(
-            "test_fallback", 10, 60, LimiterStrategy.SLIDING_WINDOW
+            "test_fallback", 3, 60, LimiterStrategy.SLIDING_WINDOW
         )
-        self.assertTrue(allowed)
-        self.assertTrue(metadata.get('fallback'))
-        self.assertIn('error', metadata)
+        self.assertFalse(allowed)
+        self.assertGreater(metadata['retry_after'], 0)
+    
+    def test_circuit_breaker_skips_redis_after_repeated_failures(self):
+        """Test that an open circuit falls back without calling Redis."""
+        mock_redis = Mock()
+        mock_redis.evalsha.side_effect = redis.RedisError("Connection failed")
+        
+        limiter = RateLimiter(mock_redis, fallback_mode=True)
+        threshold = limiter.breaker.failure_threshold
+        
+        for _ in range(threshold + 3):
+            allowed, metadata = limiter.check_limit(
+                "test_breaker", 10, 60, LimiterStrategy.SLIDING_WINDOW
+            )
+            self.assertTrue(allowed)
+            self.assertTrue(metadata.get('fallback'))
+        
+        self.assertEqual(limiter.breaker.state, "open")
+        self.assertEqual(mock_redis.evalsha.call_count, threshold)
 
 
 class TestEndToEnd(unittest.TestCase):
@@ -171,7 +319,7 @@ class TestEndToEnd(unittest.TestCase):
         """Set up test environment."""
         from app import app
         self.app = app
-        self.client = self.app.test_client()
+        self.client = self.app.test_client(use_cookies=False)
     
     def test_rate_limit_headers_present(self):
         """Test that rate limit headers are included in response."""
@@ -184,10 +332,15 @@ class TestEndToEnd(unittest.TestCase):
     
     def test_rate_limit_enforcement(self):
         """Test that rate limits are actually enforced."""
+        # Build the WSGI environ once and dispatch straight to the app, so
+        # the loop measures the limiter rather than the test client
+        environ = EnvironBuilder(method='GET', path='/api/data').get_environ()
+        
         # Make requests until we hit the limit
         responses = []
         for _ in range(15):  # More than the 10 request limit
-            response = self.client.get('/api/data')
+            with self.app.request_context(environ):
+                response = self.app.full_dispatch_request()
             responses.append(response.status_code)
         
         # Should have some 200s and some 429s
@@ -0,0 +1,61 @@
+"""
+Tests for the request log consumer.
+"""
+import unittest
+from unittest.mock import MagicMock, patch
+import psycopg2
+
+import sys
+sys.path.insert(0, '../src')
+
+import log_consumer
+
+
+def _fields(client_id: str = 'client', **overrides) -> dict:
+    fields = {
+        'client_id': client_id, 'endpoint': '/api/data', 'allowed': '1',
+        'strategy': 'token_bucket', 'limit': '10', 'remaining': '9', 'ts': '1700000000'
+    }
+    fields.update(overrides)
+    return fields
+
+
+class TestLogConsumer(unittest.TestCase):
+    """Test that bad stream entries can't block ingestion."""
+
+    def test_skips_trimmed_and_malformed_entries(self):
+        """Test that empty and unconvertible entries are dropped from the batch."""
+        rows = log_consumer.to_rows([
+            ('1-0', None),
+            ('2-0', {'client_id': 'client'}),
+            ('3-0', _fields(ts='not a number')),
+            ('4-0', _fields()),
+        ])
+        self.assertEqual(len(rows), 1)
+
+    def test_text_fields_fit_their_columns(self):
+        """Test that over-long keys and NUL bytes are cleaned before insert."""
+        row = log_consumer.to_row(_fields('k' * 1000, endpoint='/a\x00b'))
+        self.assertEqual(len(row[0]), log_consumer.TEXT_WIDTH)
+        self.assertEqual(row[1], '/ab')
+
+    def test_poison_row_is_dropped_not_retried(self):
+        """Test that a batch Postgres rejects is retried row by row."""
+        db = MagicMock()
+        inserted = []
+
+        def execute_values(cursor, sql, rows, page_size=None):
+            if len(rows) > 1 or rows[0][0] == 'poison':
+                raise psycopg2.DataError("value out of range")
+            inserted.extend(rows)
+
+        entries = [('1-0', _fields('a')), ('2-0', _fields('poison')), ('3-0', _fields('b'))]
+        with patch.object(log_consumer, 'execute_values', side_effect=execute_values):
+            log_consumer.write_batch(db, entries)
+
+        self.assertEqual([row[0] for row in inserted], ['a', 'b'])
+        self.assertEqual(db.commit.call_count, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()